@@ -5,10 +5,10 @@ from .data.file import File
 from .calibration import calibrate_sobel
 from .filters import (
     sobel_filter, gaussian_filter, taper_masked_area)
-from .stats import weighted_quartiles
+from .stats import weighted_quartiles, weighted_quartiles_batch
 
 __all__ = [
     'Box', 'DataSet', 'File',
     'calibrate_sobel', 'gaussian_filter', 'taper_masked_area',
-    'weighted_quartiles'
+    'weighted_quartiles', 'weighted_quartiles_batch'
 ]
@@ -2,69 +2,138 @@
 Calibration of space-time fractions.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from .stats import weighted_quartiles
-from .filters import sobel_filter
+from .stats import weighted_quartiles, weighted_quartiles_batch
+from .filters import sobel_filter_3d_slab
+
 
+def sobel_variances(sbc, out=None):
+    """Compute the squared temporal and spatial gradients of a normalised
+    Sobel response, relative to the squared magnitude component. The
+    expressions are evaluated in place on flattened views, reusing a
+    single temporary, so that each component of ``sbc`` is read only once.
+    The magnitude is inverted once, so that the divisions become
+    multiplications.
+
+    :param sbc: Sobel response as returned by
+        :py:func:`~hypercc.filters.sobel_filter`, with contiguous
+        components
+    :param out: optional tuple of one-dimensional arrays (var_t, var_x)
+        to write the results to
+    :return: tuple of one-dimensional ndarrays (var_t, var_x)
+    """
+    s0, s1, s2, s3 = (c.ravel() for c in np.ma.getdata(sbc))
+    if out is None:
+        out = np.empty_like(s0), np.empty_like(s1)
+    var_t, var_x = out
 
-def calibrate_sobel(quartile, box, data, delta_t, delta_d):
+    np.square(s1, out=var_x)
+    tmp = np.square(s2)
+    var_x += tmp
+    np.reciprocal(s3, out=tmp)
+    tmp *= tmp
+    var_x *= tmp
+    np.square(s0, out=var_t)
+    var_t *= tmp
+    return var_t, var_x
+
+
+def calibrate_sobel(
+        quartile, box, data, delta_t, delta_d, dtype=np.float64,
+        parallel=False, chunk_size=32):
     """Calibrate the weights of the Sobel operator.
 
     :param box: Box instance
-    :param data: ndarray or masked array with shape equal to box.shape
+    :param data: ndarray or masked array with shape equal to box.shape;
+        the mask is split off on entry and all arithmetic is done on plain
+        ndarrays
     :param delta_t: start value for delta_t
     :param delta_d: start value for delta_d
+    :param dtype: floating point type used in computing the statistics;
+        single precision halves the memory traffic, but changes the
+        result slightly.
+    :param parallel: compute slabs of the Sobel filter and independent
+        statistics in separate threads.
+    :param chunk_size: number of time steps in each slab of the Sobel
+        filter.
     :return: dictionary with statistical information about data
     """
-    sbc = sobel_filter(box, data, weight=[delta_t, delta_d, delta_d])
+    if not isinstance(box.time, np.ndarray):
+        raise ValueError(
+            "calibrate_sobel needs a box with a time axis; the 2D Sobel "
+            "filter has no magnitude component to normalise by.")
+
+    mask = np.ma.getmask(data)
+    if not mask.any():
+        mask = np.ma.nomask
+    values = np.ma.getdata(data).astype(dtype, copy=False)
+    area = box.relative_grid_area.astype(dtype)
 
+    ###Ignore nans and masked values when calculating the distributions;
+    ###each slab is compacted as soon as it is computed, so only the
+    ###selected values are ever kept in memory.
+    size = values.size
+    if mask is not np.ma.nomask:
+        size -= np.count_nonzero(mask)
+    var_t_nonans = np.empty(size, dtype=dtype)
+    var_x_nonans = np.empty_like(var_t_nonans)
+    weights = np.empty_like(var_t_nonans)
+
+    def reduce_slab(s):
+        sbc = sobel_filter_3d_slab(
+            box, values, s, weight=[delta_t, delta_d, delta_d], dtype=dtype)
+        slab_t, slab_x = sobel_variances(sbc)
+        valid = ~np.isnan(slab_x)
+        if mask is not np.ma.nomask:
+            valid &= ~mask[s].ravel()
+        slab_w = np.broadcast_to(area, sbc.shape[1:])[
+            valid.reshape(sbc.shape[1:])]
+        return (np.isnan(sbc[0:2]).sum(),
+                slab_t[valid], slab_x[valid], slab_w)
+
+    def gather(results):
+        nancount, n = 0, 0
+        for nans, slab_t, slab_x, slab_w in results:
+            m = n + slab_w.size
+            var_t_nonans[n:m] = slab_t
+            var_x_nonans[n:m] = slab_x
+            weights[n:m] = slab_w
+            nancount, n = nancount + nans, m
+        return nancount, n
+
+    slabs = [slice(t, t + chunk_size)
+             for t in range(0, box.shape[0], chunk_size)]
+    if parallel:
+        with ThreadPoolExecutor() as executor:
+            nancount, n = gather(executor.map(reduce_slab, slabs))
+    else:
+        nancount, n = gather(map(reduce_slab, slabs))
 
-    gradients=sbc[0:2]
-    nancount=np.isnan(gradients).sum()
     if nancount > 0:
         print(' ')
         print('Warning: Sobel filter yields nans!')
-        totalsize=np.size(gradients)
-        nanratio=nancount / totalsize * 100
+        totalsize = 2 * values.size
+        nanratio = nancount / totalsize * 100
         print('nans per total size in %:', nanratio)
         print(' ')
 
-   
-    
-    #sbc=np.longdouble(sbc)   # higher precision to avoid overflow
-    
-    if isinstance(data, np.ma.core.MaskedArray) \
-            and (data.mask is not np.ma.nomask):
-        var_t = (sbc[0]**2 / sbc[3]**2).compressed()
-        var_x = ((sbc[1]**2 + sbc[2]**2) / sbc[3]**2).compressed()
-        var_m = (1.0 / sbc[3]).compressed()
-        weights = np.repeat(
-            box.relative_grid_area[None, :, :],
-            box.shape[0], axis=0)[~data.mask].flatten()
-    else:
-        var_t = (sbc[0]**2 / sbc[3]**2).flatten()
-        var_x = ((sbc[1]**2 + sbc[2]**2) / sbc[3]**2).flatten()
-        var_m = (1.0 / sbc[3]).flatten()
-        weights = np.repeat(
-            box.relative_grid_area[None, :, :],
-            box.shape[0], axis=0).flatten()
-
-
-    ###Ignore nans when calculating the distributions
-    var_t_nonans = var_t[~np.isnan(var_t)]
-    var_x_nonans = var_x[~np.isnan(var_t)]
-    var_t_nonans = var_t[~np.isnan(var_x)]
-    var_x_nonans = var_x[~np.isnan(var_x)]
+    var_t_nonans = var_t_nonans[:n]
+    var_x_nonans = var_x_nonans[:n]
+    weights = weights[:n]
 
-    ft = weighted_quartiles(var_t_nonans, weights)
-    fx = weighted_quartiles(var_x_nonans, weights)
+    ft, fx = weighted_quartiles_batch(
+        [var_t_nonans, var_x_nonans], weights, parallel=parallel)
 
     fx[fx==0] = np.nan
     gamma = np.sqrt(ft / fx)
-    
 
+    ###the variances are not needed anymore, square them in place
     var_x_nonans *= gamma[quartile]
-    fm = weighted_quartiles(var_x_nonans**2 + var_t_nonans**2, weights)
+    var_m_nonans = np.square(var_x_nonans, out=var_x_nonans)
+    var_m_nonans += np.square(var_t_nonans, out=var_t_nonans)
+    fm = weighted_quartiles(var_m_nonans, weights)
 
     return {
         'time': np.sqrt(ft),
@@ -32,6 +32,8 @@ class Box:
         self.time_units = time_units
         self.time_start = time_start
 
+        self._relative_grid_area = None
+
     def __serialize__(self, pack):
         return pack({
             'time': self.time,
@@ -111,6 +113,7 @@ class Box:
 
         self.lat_bnds = lat_bnds
         self.lon_bnds = lon_bnds
+        self._relative_grid_area = None
 
     def date(self, value):
         """Convert a time value to a date."""
@@ -141,6 +144,9 @@ class Box:
         for q, t in zip(s, ['time', 'lat', 'lon']):
             setattr(new_box, t, getattr(self, t).__getitem__(s))
 
+        if len(s) > 1:
+            new_box._relative_grid_area = None
+
         return new_box
 
     @property
@@ -174,9 +180,13 @@ class Box:
 
     @property
     def relative_grid_area(self):
-        """Compute relative grid area of all pixels on the map."""
-        lat_bnds = np.radians(self.lat_bnds)
-        lon_bnds = np.radians(self.lon_bnds)
-        delta_lat = (np.sin(lat_bnds[:, 1]) - np.sin(lat_bnds[:, 0])) / 2
-        delta_lon = (lon_bnds[:, 1] - lon_bnds[:, 0]) / (2*np.pi)
-        return delta_lon[None, :] * delta_lat[:, None]
+        """Compute relative grid area of all pixels on the map. The result
+        is cached, since it only depends on the latitude and longitude
+        bounds; it is shared between calls and should not be modified."""
+        if self._relative_grid_area is None:
+            lat_bnds = np.radians(self.lat_bnds)
+            lon_bnds = np.radians(self.lon_bnds)
+            delta_lat = (np.sin(lat_bnds[:, 1]) - np.sin(lat_bnds[:, 0])) / 2
+            delta_lon = (lon_bnds[:, 1] - lon_bnds[:, 0]) / (2*np.pi)
+            self._relative_grid_area = delta_lon[None, :] * delta_lat[:, None]
+        return self._relative_grid_area
@@ -126,11 +126,59 @@ class DataSet(object):
         result.selection = selection
         return result
 
-    def annual_mean(self):
+    def time_steps(self):
+        """Indices of the selected time steps in the concatenated files.
+
+        :return: range, or None if the selection is not a slice with
+            positive step on the time axis
+        """
+        if not isinstance(self.selection, slice) \
+                or (self.selection.step or 1) < 0:
+            return None
+        return range(sum(len(f.time) for f in self.files))[self.selection]
+
+    def read(self, steps):
+        """Read a range of time steps from the files. Only those time
+        steps are read from each file, so that selecting a single month
+        does not load the entire series first.
+
+        :param steps: range of indices in the concatenated files, with
+            positive step
+        :return: masked array of float32
+        """
+        parts = []
+        offset = 0
+        for f in self.files:
+            n = len(f.time)
+            first = max(0, -((offset - steps.start) // -steps.step))
+            last = max(0, -((offset + n - steps.start) // -steps.step))
+            local = steps[first:last]
+            if local:
+                parts.append(f.get_masked(
+                    self.variable,
+                    slice(local.start - offset, local[-1] - offset + 1,
+                          local.step)).astype('float32'))
+            offset += n
+        return np.ma.concatenate(parts)
+
+    def annual_mean(self, block_size=16):
+        """Compute the annual mean of monthly data. The data is read and
+        averaged `block_size` years at a time, so the monthly series is
+        never in memory as a whole.
+
+        :param block_size: number of years read at once
+        :return: LoadedDataSet
+        """
         shape = (self.box.shape[0] // 12, 12) + self.box.shape[1:]
-        return LoadedDataSet(
-            self.box[::12][:shape[0]],
-            self.data[:shape[0]*12].reshape(shape).mean(axis=1).astype('float32'))
+        steps = self.time_steps()
+        if steps is None:
+            data = self.data[:shape[0]*12].reshape(shape).mean(axis=1)
+        else:
+            data = np.ma.concatenate([
+                self.read(steps[12*y:12*min(y + block_size, shape[0])])
+                    .reshape((-1,) + shape[1:]).mean(axis=1)
+                for y in range(0, shape[0], block_size)])
+        return LoadedDataSet(self.box[::12][:shape[0]], data.astype('float32'))
 
     @property
     def box(self):
@@ -175,7 +223,10 @@ class DataSet(object):
 
     @property
     def data(self):
-        """Concatenates data from entire dataset into single array."""
-        return np.ma.concatenate(
-            [f.get_masked(self.variable).astype('float32')
-             for f in self.files])[self.selection]
+        """Concatenates data from entire dataset into single array. A slice
+        on the time axis is applied while reading the files."""
+        steps = self.time_steps()
+        if steps is None:
+            return self.read(range(sum(len(f.time) for f in self.files)))[
+                self.selection]
+        return self.read(steps)
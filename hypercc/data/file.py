@@ -74,7 +74,7 @@ class File(object):
         """
         return self.data.variables[var][self.bounds]
 
-    def get_masked(self, var):
+    def get_masked(self, var, selection=slice(None)):
         """The NetCDF file may specify a floating point value for missing
         values, for instance in the case of variables that only have valid
         entries on sea or land cells. In this case we'd like to obtain a
@@ -82,8 +82,19 @@ class File(object):
 
         This function returns a masked array for the given variable. When no
         mask is needed, a normal numpy array is returned.
+
+        :param var: name of the variable
+        :param selection: slice of the time steps within the bounds; only
+            these are read from the file
         """
-        data = self.data.variables[var][self.bounds]
+        variable = self.data.variables[var]
+        steps = range(variable.shape[0])[self.bounds][selection]
+        if steps.step == 1:
+            data = variable[steps.start:steps.stop]
+        else:
+            # strided reads are slow in libnetcdf, reading the time steps
+            # one by one is several times faster
+            data = np.ma.stack([variable[i] for i in steps])
         #_ = self.data.variables[var]
         # print(self.data.variables[var])
         #self.data.variables[var].missing_value = 1e20
@@ -98,7 +109,9 @@ class File(object):
         # squeeze out extra dimensions so that filter works correctly
         # also make sure it is indeed a masked array
         ## TODO: change this back after all files are masked
-        masked_data = masked_data.squeeze()
+        # the time axis is kept, a selection may contain a single time step
+        masked_data = masked_data.squeeze(axis=tuple(
+            i for i, n in enumerate(masked_data.shape) if n == 1 and i > 0))
         masked_data = np.ma.masked_array(masked_data)
         return masked_data
 
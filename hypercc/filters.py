@@ -3,6 +3,7 @@ Implements different filters on spherical grid.
 """
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from scipy import ndimage
@@ -37,7 +38,8 @@ def gaussian_filter_2d(box, data, sigma_lat, sigma_lon):
     return outp
 
 
-def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon):
+def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon,
+                       parallel=False, chunk_size=32):
     """Filters a 3D (time x lat x lon) data set with a Gaussian, correcting for
     the distortion from the geographic projection.
 
@@ -46,6 +48,9 @@ def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon):
     :param sigma_t: sigma time in dimension of time (e.g. year).
     :param sigma_lat: sigma lat in dimension of distance (e.g. km).
     :param sigma_lon: sigma lon in dimension of distance (e.g. km).
+    :param parallel: filter the latitudes, and then slabs of longitudes, in
+        separate threads.
+    :param chunk_size: number of longitudes in each slab of the second pass.
     :return: :py:class:`numpy.ndarray` with the same shape as input.
     """
     res_t, res_lat, res_lon = box.resolution
@@ -54,9 +59,67 @@ def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon):
     s_lon = (sigma_lon / res_lon).m_as('')
 
     outp = np.zeros_like(data)
-    for i, lat_rad in enumerate(box.lat_bnds.mean(axis=1) / 180 * np.pi):
+    lats = box.lat_bnds.mean(axis=1) / 180 * np.pi
+
+    def filter_latitude(i):
         ndimage.gaussian_filter(
             data[:, i, :],
+            min(data.shape[2], s_lon / np.cos(lats[i])),
+            mode=['reflect', 'wrap'],
+            output=outp[:, i, :])
+
+    # the second pass does not filter along longitude, so slabs of
+    # longitudes are independent
+    def filter_slab(s):
+        ndimage.gaussian_filter(
+            outp[:, :, s], [s_t, s_lat, 0.0],
+            mode=['reflect', 'reflect', 'wrap'], output=outp[:, :, s])
+
+    if parallel:
+        slabs = [slice(j, j + chunk_size)
+                 for j in range(0, data.shape[2], chunk_size)]
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(filter_latitude, range(data.shape[1])))
+            list(executor.map(filter_slab, slabs))
+    else:
+        for i in range(data.shape[1]):
+            filter_latitude(i)
+        filter_slab(slice(None))
+
+    return outp
+
+
+def gaussian_filter_3d_point(
+        box, data, sigma_t, sigma_lat, sigma_lon, lat_index, lon_index):
+    """Compute the time series at a single grid point of
+    :py:func:`gaussian_filter_3d`. Only the latitudes within reach of the
+    latitudinal kernel are filtered, so the result is identical to that
+    of filtering the full data set, at a fraction of the cost.
+
+    :param box: instance of :py:class:`Box`.
+    :param data: data set, dimensions should match ``box.shape``.
+    :param sigma_t: sigma time in dimension of time (e.g. year).
+    :param sigma_lat: sigma lat in dimension of distance (e.g. km).
+    :param sigma_lon: sigma lon in dimension of distance (e.g. km).
+    :param lat_index: latitude index of the grid point.
+    :param lon_index: longitude index of the grid point.
+    :return: :py:class:`numpy.ndarray` with the filtered time series.
+    """
+    res_t, res_lat, res_lon = box.resolution
+    s_t = (sigma_t / res_t).m_as('')
+    s_lat = (sigma_lat / res_lat).m_as('')
+    s_lon = (sigma_lon / res_lon).m_as('')
+
+    # same radius as used by ndimage.gaussian_filter1d
+    radius = int(4.0 * s_lat + 0.5)
+    lo = max(lat_index - radius, 0)
+    hi = min(lat_index + radius + 1, data.shape[1])
+
+    outp = np.zeros_like(data[:, lo:hi])
+    lats = box.lat_bnds[lo:hi].mean(axis=1) / 180 * np.pi
+    for i, lat_rad in enumerate(lats):
+        ndimage.gaussian_filter(
+            data[:, lo + i, :],
             min(data.shape[2], s_lon / np.cos(lat_rad)),
             mode=['reflect', 'wrap'],
             output=outp[:, i, :])
@@ -65,7 +128,7 @@ def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon):
         outp, [s_t, s_lat, 0.0], mode=['reflect', 'reflect', 'wrap'],
         output=outp)
 
-    return outp
+    return outp[:, lat_index - lo, lon_index]
 
 
 def sobel_filter_2d(box, data, weight=None, physical=True):
@@ -89,19 +152,69 @@ def sobel_filter_2d(box, data, weight=None, physical=True):
         weight = [(1/8 * w / r).m_as('')
                   for w, r in zip(weight, box.resolution)]
 
-    result = np.array([
-        ndimage.sobel(data, mode=['reflect', 'wrap'], axis=i) * weight[i]
-        for i in range(2)])
+    result = np.empty((3,) + data.shape, dtype=np.result_type(data, *weight))
+    for i in range(2):
+        ndimage.sobel(
+            data, mode=['reflect', 'wrap'], axis=i, output=result[i])
+        result[i] *= weight[i]
 
     if physical:
         result[1, :, :] /= np.cos(box.lat / 180 * np.pi)[:, None]
 
-    result = np.r_[result, np.ones_like(result[0:1])]
-    norm = np.sqrt((result[:-1]**2).sum(axis=0))
+    result[2] = 1.0
+    norm = np.square(result[0])
+    norm += np.square(result[1])
+    np.sqrt(norm, out=norm)
     result /= norm
     return result
 
 
+def sobel_weights_3d(box, weight=None):
+    """Convert the weights of the 3D Sobel filter to dimensionless factors
+    per pixel, see :py:func:`sobel_filter_3d`."""
+    if weight is None:
+        return [1/16, 1/16, 1/16]
+    else:
+        return [(1/16 * w / r).m_as('')
+                for w, r in zip(weight, box.resolution)]
+
+
+def apply_sobel_3d(
+        box, data, weight, physical=True, variability=None, dtype=None):
+    """Compute the normalised 3D Sobel filter, given dimensionless
+    weights as returned by :py:func:`sobel_weights_3d`. Only the latitudes
+    of ``box`` are used, so ``data`` may be a slice of the full time axis.
+    The components are written directly into a single C-contiguous array,
+    so that each ``result[i]`` is contiguous as well. If ``dtype`` is not
+    given, it is the floating point type of ``data``; the weights are
+    scalars and never promote single precision data to double."""
+    if dtype is None:
+        dtype = np.result_type(data, *(float(w) for w in weight))
+    result = np.empty((4,) + data.shape, dtype=dtype)
+    for i in range(3):
+        ndimage.sobel(
+            data, mode=['reflect', 'reflect', 'wrap'], axis=i,
+            output=result[i])
+        result[i] *= weight[i]
+
+    if variability is not None:
+        for i in range(3):
+            result[i] /= variability[i]
+
+    if physical:
+        factor = np.cos(box.lat_bnds.mean(axis=1) / 180 * np.pi)[None, :, None]
+        result[2, :, :, :] /= factor
+
+    result[3] = 1.0
+    norm = np.square(result[0])
+    norm += np.square(result[1])
+    norm += np.square(result[2])
+    np.sqrt(norm, out=norm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result /= norm
+    return result
+
+
 def sobel_filter_3d(box, data, weight=None, physical=True, variability=None):
     """Sobel filter in 3D (time x lat x lon). Effectively computes a
     derivative.  This filter is normalised to return a rate of change per
@@ -117,30 +230,33 @@ def sobel_filter_3d(box, data, weight=None, physical=True, variability=None):
     :param physical: wether to correct for geometric projection, by dividing
         the derivative in the longitudinal direction by the cosine of the
         latitude."""
-    if weight is None:
-        weight = [1/16, 1/16, 1/16]
-    else:
-        weight = [(1/16 * w / r).m_as('')
-                  for w, r in zip(weight, box.resolution)]
+    return apply_sobel_3d(
+        box, data, sobel_weights_3d(box, weight), physical, variability)
 
-    result = np.array([
-        ndimage.sobel(
-            data, mode=['reflect', 'reflect', 'wrap'], axis=i) * weight[i]
-        for i in range(3)])
 
-    if variability is not None:
-        for i in range(3):
-            result[i] /= variability[i]
+def sobel_filter_3d_slab(
+        box, data, time_slice, weight=None, physical=True, dtype=None):
+    """Sobel filter in 3D, computed for a slab ``data[time_slice]`` along
+    the time axis, so that the full four-component result never has to be
+    held in memory. The Sobel kernel extends one pixel along each axis, so
+    the slab is computed with one extra time step on either side; the
+    results are identical to the corresponding slice of
+    :py:func:`sobel_filter_3d`.
 
-    if physical:
-        factor = np.cos(box.lat_bnds.mean(axis=1) / 180 * np.pi)[None, :, None]
-        result[2, :, :, :] /= factor
-
-    result = np.r_[result, np.ones_like(result[0:1])]
-    norm = np.sqrt((result[:-1]**2).sum(axis=0))
-    with np.errstate(divide='ignore', invalid='ignore'):
-        result /= norm
-    return result
+    :param box: :py:class:`Box` instance
+    :param data: input data, :py:class:`numpy.ndarray` with same shape
+        as ``box.shape``.
+    :param time_slice: slice along the time axis, with unit step.
+    :param weight: see :py:func:`sobel_filter_3d`.
+    :param physical: see :py:func:`sobel_filter_3d`.
+    :param dtype: floating point type of the result.
+    :return: :py:class:`numpy.ndarray` with the Sobel filter of the slab."""
+    start, stop, _ = time_slice.indices(data.shape[0])
+    lo, hi = max(start - 1, 0), min(stop + 1, data.shape[0])
+    result = apply_sobel_3d(
+        box, data[lo:hi], sobel_weights_3d(box, weight), physical,
+        dtype=dtype)
+    return result[:, start-lo:stop-lo]
 
 
 def sobel_filter_3d_masked(
@@ -160,30 +276,33 @@ def taper_masked_area(data, size, n_steps):
     """Iteratively bleed values from valid regions into the masked area using
     a uniform filter. This should limit boundary effects when filtering later
     on. The masked area is zeroed before running. Output is written back to the
-    original data."""
+    original data; if nothing is masked, the data is left as it is."""
     if not isinstance(data, np.ma.core.MaskedArray):
         raise TypeError("Expected a masked array.")
 
-    if data.mask is np.ma.nomask:
+    if data.mask is np.ma.nomask or not data.mask.any():
         print("Land-sea mask is empty. No smoothing at coasts is needed.", file=sys.stderr)
+        return
 
     data.data[data.mask] = 0.0
+    temp = np.empty_like(data.data)
     for _ in range(n_steps):
-        temp = ndimage.uniform_filter(data.data, size, mode='wrap')
-        data.data[data.mask] = temp[data.mask]
+        ndimage.uniform_filter(data.data, size, mode='wrap', output=temp)
+        np.copyto(data.data, temp, where=data.mask)
 
 
-def gaussian_filter(box, data, sigma):
+def gaussian_filter(box, data, sigma, parallel=False):
     """Filters a data set with a Gaussian, correcting for the distortion
     from the geographic projection.
 
     :param box: instance of :py:class:`Box`.
     :param data: data set, dimensions should match ``box.shape``.
     :param sigma: list of sigmas with the correct dimension.
+    :param parallel: filter 3D data in separate threads.
     :return: :py:class:`numpy.ndarray` with the same shape as input.
     """
     if isinstance(box.time, np.ndarray):
-        return gaussian_filter_3d(box, data, *sigma)
+        return gaussian_filter_3d(box, data, *sigma, parallel=parallel)
     else:
         return gaussian_filter_2d(box, data, *sigma)
 
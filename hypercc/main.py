@@ -1,15 +1,16 @@
 import warnings
 import sys
-import locale
 # import noodles
 import argparse
 
-from .workflow import generate_report, run, run_single
 from .units import MONTHS
 
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
-locale.setlocale(locale.LC_ALL, '')
+
+MONTH_CHOICES = tuple(MONTHS) \
+    + tuple(str(i) for i in range(1, 13)) \
+    + tuple('{:02}'.format(i) for i in range(1, 10))
 
 
 def print_nlesc_logo():
@@ -56,7 +57,9 @@ def make_argument_parser():
 
     report_parser = subparser.add_parser(
         "report", help="generate complete report")
-    report_parser.set_defaults(func=generate_report)
+    # resolved in `hypercc.workflow` after parsing, so that the heavy
+    # imports are skipped for `--help` and argument errors
+    report_parser.set_defaults(func='generate_report')
 
     report_parser.add_argument(
         "--model", help="model name in CMIP5 naming scheme",
@@ -86,8 +89,7 @@ def make_argument_parser():
         "--month", help="which month to study, give abbreviated month name "
         "as by your locale, or a number in the inclusive range of [1-12].",
         default=MONTHS[0],
-        choices=MONTHS + list(map(str, range(1, 13)))
-        + list(map('{:02}'.format, range(1, 10))))
+        choices=MONTH_CHOICES)
     report_parser.add_argument(
         "--sigma-x", help="spacial smoothing scale, quantity with unit "
         "(default: 200 km)",
@@ -122,9 +124,18 @@ def make_argument_parser():
         "--sobel-scale", help="scaling of time/space in magnitude of Sobel"
         " operator, should have dimensionality of velocity. (default: "
         "10 km/year)", nargs=2, default=['10', 'km/year'], dest='sobel_scale')
+    report_parser.add_argument(
+        "--single-precision", help="compute calibration statistics in "
+        "single precision, using less memory (default: double precision)",
+        dest='single_precision', action='store_true')
     report_parser.add_argument(
         "--no-taper", help="taper data to handle land/sea mask.",
         dest='taper', action='store_false')
+    report_parser.add_argument(
+        "--calibration-cache", help="reuse the calibration of an earlier "
+        "report on the same piControl run and settings, stored in "
+        ".calib_cache next to the output folder.",
+        dest='calibration_cache', action='store_true')
 
     return parser
 
@@ -132,10 +143,6 @@ def make_argument_parser():
 if __name__ == "__main__":
     import logging
 
-    # disable interactive plotting
-    import matplotlib
-    matplotlib.use('SVG')
-
     print_nlesc_logo()
     logging.getLogger('root').setLevel(logging.WARNING)
     # logging.getLogger('noodles').setLevel(logging.WARNING)
@@ -147,11 +154,16 @@ if __name__ == "__main__":
         args.month = MONTHS[int(args.month) - 1]
 
     if args.command == 'report':
-        workflow = args.func(args)
+        # disable interactive plotting; all plots are rendered to PNG
+        import matplotlib
+        matplotlib.use('Agg')
+
+        from . import workflow
+        report = getattr(workflow, args.func)(args)
         if args.single:
-            results = run_single(workflow)
+            results = workflow.run_single(report)
         else:
-            results = run(workflow)
+            results = workflow.run(report)
 
         if results:
             print(results['calibration'])
@@ -1,17 +1,57 @@
+"""
+Plotting routines for the report. Figures are made with the object
+oriented API instead of pyplot, which keeps every figure alive until it
+is closed.
+"""
+import io
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import cartopy.crs as ccrs
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.colors as colors
+import matplotlib.image as mpimage
+from matplotlib.figure import Figure
 import numpy as np
 
 
+# zlib level for the PNG files of the report; level 1 encodes several
+# times faster than the default of 6, for somewhat larger files
+PNG_OPTIONS = {'compress_level': 1}
+
+# figures kept between reports, see `reuse_figure`
+FIGURE_POOL = {}
+
+
+def reuse_figure(key, figsize=None):
+    """Get a cleared figure from a pool of figures kept between reports,
+    creating it on first use. Generating many reports in one process then
+    does not allocate a new figure and canvas for each of them.
+
+    :param key: name of the figure in the pool
+    :param figsize: size of the figure in inches, used on creation
+    :return: matplotlib Figure
+    """
+    fig = FIGURE_POOL.get(key)
+    if fig is None:
+        fig = Figure(figsize=figsize)
+        FIGURE_POOL[key] = fig
+    else:
+        fig.clear()
+    return fig
+
+
 def earth_plot(
         box, value,
         projection=ccrs.PlateCarree(),
         transform=ccrs.RotatedPole(pole_longitude=180.0, pole_latitude=90),
         patch_greenwich=True,
         patch_north_pole=False,
+        fig=None,
         **pargs):
-    """Wrapper around Cartopy plotting, using `pcolormesh`."""
+    """Wrapper around Cartopy plotting, using `pcolormesh`. If `fig` is
+    given, that figure is cleared and reused instead of creating a new
+    one."""
 
     lons = box.lon.copy()
     lats = box.lat.copy()
@@ -24,14 +64,16 @@ def earth_plot(
         lats = np.concatenate([lats, [90.0]])
         value = np.concatenate([value[:, :], value[0:1, :]], axis=0)
 
-    fig = plt.figure(figsize=(20, 10))
+    if fig is None:
+        fig = Figure(figsize=(20, 10))
+    else:
+        fig.clear()
     ax = fig.add_subplot(111, projection=projection)
     pcm = ax.pcolormesh(
         lons, lats, value, **pargs,
         transform=transform)
     ax.coastlines()
     fig.colorbar(pcm)
-    plt.close()
     return fig
 
 
@@ -60,7 +102,7 @@ def plot_plate_carree(box, value, **pargs):
 def plot_signal_histogram(box, signal, lower, upper, **pargs):
     """Plot the signal histogram: this shows the evolution of the
     Sobel signal strength over time."""
-    fig = plt.figure()
+    fig = Figure()
     ax = fig.add_subplot(111)
 
     # flatten sobel signal
@@ -90,3 +132,125 @@ def plot_signal_histogram(box, signal, lower, upper, **pargs):
     return fig
 
 
+def savefig_dpi(fig=None):
+    """Resolution at which figures are saved, following
+    ``rcParams['savefig.dpi']`` in the same way as ``savefig`` does.
+
+    :param fig: matplotlib Figure, for the value 'figure'; the default
+        figure dpi is used if not given
+    :return: dots per inch
+    """
+    dpi = matplotlib.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = matplotlib.rcParams['figure.dpi'] if fig is None else fig.dpi
+    return dpi
+
+
+def render_figure(fig):
+    """Render a figure to an RGBA image, cropped to its tight bounding box
+    in the same way as ``savefig(bbox_inches='tight')`` does.
+
+    :param fig: matplotlib Figure
+    :return: ndarray of uint8 with shape (height, width, 4)
+    """
+    dpi = savefig_dpi(fig)
+    pad = matplotlib.rcParams['savefig.pad_inches']
+    # text extents depend on the resolution, so the bounding box is
+    # measured at the resolution of the output, as savefig does
+    figure_dpi = fig.dpi
+    fig.dpi = dpi
+    try:
+        bbox = fig.get_tightbbox().padded(pad)
+    finally:
+        fig.dpi = figure_dpi
+    buf = io.BytesIO()
+    fig.savefig(buf, format='rgba', dpi=dpi, bbox_inches=bbox)
+    width, height = int(bbox.width * dpi), int(bbox.height * dpi)
+    return np.frombuffer(buf.getbuffer(), np.uint8).reshape(height, width, 4)
+
+
+def save_image(image, filename, images=None):
+    """Save a rendered figure as PNG. If a dictionary ``images`` is given,
+    the image is stored in it under the path of the file and writing the
+    PNG is left to :py:func:`write_images`; in the meantime the image can
+    be reused without reading the PNG back.
+
+    :param image: ndarray of uint8 with shape (height, width, 4)
+    :param filename: path of the PNG file
+    :param images: optional dictionary to store the image in
+    :return: Path to the file
+    """
+    if images is None:
+        write_png(filename, image)
+    else:
+        images[Path(filename)] = image
+    return Path(filename)
+
+
+def save_figure(fig, filename, images=None):
+    """Save a figure as PNG, cropped to its tight bounding box, see
+    :py:func:`save_image`. The figure is rendered only once.
+
+    :param fig: matplotlib Figure
+    :param filename: path of the PNG file
+    :param images: optional dictionary to store the image in
+    :return: Path to the file
+    """
+    return save_image(render_figure(fig), filename, images)
+
+
+def write_png(filename, image):
+    """Write an RGBA image to a PNG file. The resolution stored in the file
+    is the one at which :py:func:`render_figure` renders.
+
+    :param filename: path of the PNG file
+    :param image: ndarray of uint8 with shape (height, width, 4)
+    """
+    mpimage.imsave(
+        str(filename), image, dpi=savefig_dpi(),
+        pil_kwargs=PNG_OPTIONS)
+
+
+def tile_images(grid):
+    """Compose RGBA images into a single image, laid out on a grid. Each
+    cell is as high as the highest image in its row and as wide as the
+    widest image in its column; images are centred in their cell on a
+    white background. The images keep their full resolution, where
+    drawing them on the axes of a new figure would resample them.
+
+    :param grid: list of rows, each a list of images, or None for an empty
+        cell
+    :return: ndarray of uint8 with shape (height, width, 4)
+    """
+    heights = [max((im.shape[0] for im in row if im is not None), default=0)
+               for row in grid]
+    widths = [max((row[j].shape[1] for row in grid if row[j] is not None),
+                  default=0)
+              for j in range(len(grid[0]))]
+    result = np.full((sum(heights), sum(widths), 4), 255, dtype=np.uint8)
+
+    top = 0
+    for row, height in zip(grid, heights):
+        left = 0
+        for im, width in zip(row, widths):
+            if im is not None:
+                y = top + (height - im.shape[0]) // 2
+                x = left + (width - im.shape[1]) // 2
+                result[y:y + im.shape[0], x:x + im.shape[1]] = im
+            left += width
+        top += height
+    return result
+
+
+def write_images(images, parallel=False):
+    """Write the images collected by :py:func:`save_figure` to PNG files.
+
+    :param images: dictionary of RGBA images by path
+    :param parallel: write the files from a thread pool
+    """
+    if parallel and len(images) > 1:
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(write_png, images.keys(), images.values()))
+    else:
+        for filename, image in images.items():
+            write_png(filename, image)
@@ -1,6 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
 import numpy as np
 
 
+QUARTILES = np.array([0, 1/4, 1/2, 3/4, 1])
+
+
+def weighted_select(sample, weights, targets, cutoff=256):
+    """Weighted selection. For each target `t`, find the smallest value `v`
+    in the sample such that the total weight of all elements not larger than
+    `v` is at least `t`. This is the weighted analogue of quickselect: the
+    sample is partitioned around its median element, and the search
+    continues only in the halves that contain a target. All targets are
+    resolved in the same pass, so the cost is linear in the size of the
+    sample, instead of the `n log n` of a full sort. Targets at or beyond
+    the ends of the cumulative weight select the minimum and maximum.
+    The input is made contiguous first, so that all the gathers (done with
+    `np.take`) stream through memory.
+
+    :param sample: data sample, one-dimensional array
+    :param weights: weights, one-dimensional array, same length as sample
+    :param targets: cumulative weights to look for, one-dimensional array
+    :param cutoff: below this size, remaining parts are sorted directly
+    :returns: an array with the selected value for each target
+    """
+    sample = np.ascontiguousarray(sample)
+    weights = np.ascontiguousarray(weights)
+    targets = np.asarray(targets, dtype=float)
+    result = np.empty(targets.shape, dtype=sample.dtype)
+
+    # the extremes are found by a single reduction instead of a descent
+    lowest = targets <= 0
+    highest = targets >= weights.sum()
+    if lowest.any():
+        result[lowest] = sample.min()
+    if highest.any():
+        result[highest] = sample.max()
+
+    inner = np.flatnonzero(~lowest & ~highest)
+    todo = [(sample, weights, inner, targets[inner])] if inner.size else []
+
+    while todo:
+        s, w, which, t = todo.pop()
+        if s.size <= cutoff:
+            order = np.argsort(s)
+            F = np.cumsum(np.take(w, order))
+            indices = np.minimum(np.searchsorted(F, t), s.size - 1)
+            result[which] = np.take(s, np.take(order, indices))
+            continue
+
+        k = s.size // 2
+        part = np.argpartition(s, k)
+        lower, upper = part[:k], part[k+1:]
+        w_lower = np.take(w, lower)
+        total_lower = w_lower.sum()
+        w_pivot = total_lower + w[part[k]]
+
+        left = t <= total_lower
+        right = t > w_pivot
+        result[which[~left & ~right]] = s[part[k]]
+        if left.any():
+            todo.append((np.take(s, lower), w_lower, which[left], t[left]))
+        if right.any():
+            todo.append((np.take(s, upper), np.take(w, upper), which[right],
+                         t[right] - w_pivot))
+
+    return result
+
+
 def weighted_quartiles(sample, weights):
     """Compute the minimum, first quartile, median, third
     quartile and the maximum of the weighted sample.
@@ -9,9 +77,23 @@ def weighted_quartiles(sample, weights):
     :param weights: weights, one-dimensional array, same length as sample
     :returns: an array of five elements [min, 1st, med, 3rd, max]
     """
-    quartiles = np.array([0, 1/4, 1/2, 3/4, 1])
-    order = np.argsort(sample)
-    F = np.cumsum(weights[order])
-    indices = [min(i, order.size-1)
-               for i in np.searchsorted(F, F[-1] * quartiles)]
-    return sample[order[indices]]
+    return weighted_select(sample, weights, weights.sum() * QUARTILES)
+
+
+def weighted_quartiles_batch(samples, weights, parallel=False):
+    """Compute the weighted quartiles of several samples that share the
+    same weights.
+
+    :param samples: sequence of one-dimensional arrays, all of the same
+        length as weights
+    :param weights: weights, one-dimensional array
+    :param parallel: process the samples concurrently, one thread each
+    :returns: an array of shape (len(samples), 5), each row containing
+        [min, 1st, med, 3rd, max] of the corresponding sample
+    """
+    if parallel and len(samples) > 1:
+        with ThreadPoolExecutor(max_workers=len(samples)) as executor:
+            return np.array(list(executor.map(
+                weighted_quartiles, samples, repeat(weights))))
+
+    return np.array([weighted_quartiles(s, weights) for s in samples])
@@ -1,22 +1,39 @@
 """
 Implements the HyperCanny workflow for climate data.
+
+Unless `single` is set in the configuration, the heavy steps are run on
+a pool of threads: filtering, statistics and PNG compression are done in
+NumPy, SciPy and Pillow routines that release the GIL, so the threads do
+run concurrently.
 """
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import cartopy.crs as ccrs
 import numpy as np
-from scipy import ndimage, stats
+from scipy import ndimage
 import xarray as xr
 
 from hyper_canny import cp_edge_thinning, cp_double_threshold
 
-from .data.data_set import DataSet
+from .data.data_set import DataSet, LoadedDataSet
 from .units import unit, month_index
-from .filters import gaussian_filter, sobel_filter, taper_masked_area
+from .filters import (
+    gaussian_filter, gaussian_filter_3d_point, sobel_filter, taper_masked_area)
 from .calibration import calibrate_sobel
-from .plotting import plot_signal_histogram, plot_plate_carree
+from .plotting import (
+    plot_signal_histogram, plot_plate_carree, render_figure, reuse_figure,
+    save_figure, save_image, tile_images, write_images)
+
+
+QUARTILE_IDX = {'min': 0, '1st': 1, 'median': 2, '3rd': 3, 'max': 4}
+
+# part of the key of cached calibrations; increase it whenever the result
+# of `compute_calibration` changes, so that old cache files are not used
+CALIBRATION_VERSION = 1
 
 
 def run(workflow):
@@ -109,9 +126,22 @@ def annual_mean(data_set):
     return data_set.annual_mean()
 
 
+def reduce_data_set(config, data_set):
+    """Take the annual mean or select a single month, following `config`.
+    The result is loaded in memory, so the files are read only once.
+
+    :param config: namespace object (as returned by argparser)
+    :param data_set: DataSet
+    :return: LoadedDataSet
+    """
+    if config.annual:
+        return annual_mean(data_set)
+    data_set = select_month(config, data_set)
+    return LoadedDataSet(data_set.box, data_set.data)
+
+
 def compute_calibration(config, data_set):
-    quartile = ['min', '1st', 'median', '3rd', 'max'] \
-        .index(config.calibration_quartile)
+    quartile = QUARTILE_IDX[config.calibration_quartile]
     sigma_t, sigma_x = get_sigmas(config)
     sobel_scale = float(config.sobel_scale[0]) * unit(config.sobel_scale[1])
     sobel_delta_t = 1.0 * unit.year
@@ -130,18 +160,74 @@ def compute_calibration(config, data_set):
         print("    tapering on")
         taper_masked_area(data, [0, 5, 5], 50)
 
-    smooth_data = gaussian_filter(box, data, [sigma_t, sigma_x, sigma_x])
-    calibration = calibrate_sobel(quartile, box, smooth_data, sobel_delta_t, sobel_delta_x)
+    smooth_data = gaussian_filter(
+        box, data, [sigma_t, sigma_x, sigma_x], parallel=not config.single)
+    dtype = np.float32 if config.single_precision else np.float64
+    calibration = calibrate_sobel(
+        quartile, box, smooth_data, sobel_delta_t, sobel_delta_x, dtype,
+        parallel=not config.single)
 
     return calibration
 
 
+def calibration_cache_path(config, control_set):
+    """Path of the cached calibration for `control_set`. The file name is a
+    hash of the control files, with their modification times, of the
+    variable and floating point type, of all settings that enter
+    :py:func:`compute_calibration`, and of `CALIBRATION_VERSION`.
+
+    :param config: namespace object (as returned by argparser)
+    :param control_set: DataSet of the pi-control run
+    :return: Path
+    """
+    dtype = np.float32 if config.single_precision else np.float64
+    key = (
+        CALIBRATION_VERSION,
+        sorted((str(p), p.stat().st_mtime_ns) for p in control_set.paths),
+        control_set.variable, np.dtype(dtype).name,
+        config.annual, None if config.annual else config.month,
+        config.sigma_t, config.sigma_x, config.sobel_scale,
+        config.calibration_quartile, config.taper)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return Path(config.output_folder).parent / '.calib_cache' \
+        / '{}.npz'.format(digest)
+
+
+def read_calibration(cache):
+    """Read a calibration stored by :py:func:`write_calibration`.
+
+    :param cache: path of the npz file
+    :return: calibration dictionary
+    """
+    with np.load(cache) as f:
+        return {k: f[k] for k in f.files}
+
+
+def write_calibration(cache, calibration):
+    """Store a calibration in an npz file. The file is written under a
+    temporary name first, so that concurrent reports never read a partial
+    cache.
+
+    :param cache: path of the npz file
+    :param calibration: calibration dictionary
+    """
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_suffix('.{}.tmp'.format(os.getpid()))
+    with open(tmp, 'wb') as f:
+        np.savez(f, **calibration)
+    os.replace(tmp, cache)
+
+
 def get_calibration_factor(config, calibration):
-    quartile = ['min', '1st', 'median', '3rd', 'max'] \
-        .index(config.calibration_quartile)
+    quartile = QUARTILE_IDX[config.calibration_quartile]
     gamma = calibration['gamma'][quartile]
     #print("Calibration gamma[{}] = {}"
     #      .format(config.calibration_quartile, gamma))
+    if not gamma > 0:
+        raise ValueError(
+            "Calibration factor for the {} quartile is {}, choose another "
+            "--calibration-quartile.".format(
+                config.calibration_quartile, gamma))
     return gamma
 
 
@@ -151,39 +237,65 @@ def get_sigmas(config):
     return sigma_t, sigma_x
 
 
-def get_sobel_weights(config, calibration):
+def get_sobel_weights(config, calibration, gamma=None):
     sobel_scale = float(config.sobel_scale[0]) * unit(config.sobel_scale[1])
-    gamma = get_calibration_factor(config, calibration)
+    if gamma is None:
+        gamma = get_calibration_factor(config, calibration)
     sobel_delta_t = 1.0 * unit.year
     sobel_delta_x = sobel_delta_t * sobel_scale * gamma
     return [sobel_delta_t, sobel_delta_x, sobel_delta_x]
 
 
 def generate_signal_plot(
-        config, calibration, box, sobel_data, title, filename):
+        config, calibration, box, sobel_data, title, filename, inv_mag=None,
+        images=None):
     lower, upper = get_thresholds(config, calibration)
-    fig = plot_signal_histogram(box, 1 / sobel_data[3], lower, upper)
+    if inv_mag is None:
+        inv_mag = 1 / sobel_data[3]
+    fig = plot_signal_histogram(box, inv_mag, lower, upper)
     fig.suptitle(title, fontsize=20)
     try:
-        fig.savefig(str(filename), bbox_inches='tight')
+        image = render_figure(fig)
     except ValueError:
         # save some mock data to prevent crashing of program
-        fig = plt.figure()
-        plt.plot([0, 1], [0, 1])
-        fig.savefig(str(filename), bbox_inches='tight')
-    return Path(filename)
+        fig = Figure()
+        fig.add_subplot(111).plot([0, 1], [0, 1])
+        image = render_figure(fig)
+    return save_image(image, filename, images)
 
 
-def maximum_suppression(sobel_data):
+def transposed_copy(data, out=None, block=(64, 16)):
+    """Copy a 4D array with its axes reversed, as needed by the
+    `hyper_canny` routines. The copy is done in blocks of time steps and
+    latitudes, so that both reading and writing stay within the cache.
+
+    :param data: ndarray or masked array of shape (4, time, lat, lon)
+    :param out: optional ndarray of shape (lon, lat, time, 4) to reuse
+    :param block: number of time steps and latitudes in each block
+    :return: ndarray of shape (lon, lat, time, 4)
+    """
+    data = np.ma.getdata(data)
+    if out is None:
+        out = np.empty(data.shape[::-1], dtype=data.dtype)
+    bt, by = block
+    for t in range(0, data.shape[1], bt):
+        for y in range(0, data.shape[2], by):
+            out[:, y:y+by, t:t+bt] = \
+                data[:, t:t+bt, y:y+by].transpose([3, 2, 1, 0])
+    return out
+
+
+def maximum_suppression(sobel_data, buffer=None):
     print("transposing data")
-    trdata = sobel_data.transpose([3, 2, 1, 0]).copy()
+    trdata = transposed_copy(sobel_data, buffer)
     print("applying thinning")
     mask = cp_edge_thinning(trdata)
     return mask.transpose([2, 1, 0])
 
 
-def get_thresholds(config, calibration):
-    gamma = get_calibration_factor(config, calibration)
+def get_thresholds(config, calibration, gamma=None):
+    if gamma is None:
+        gamma = get_calibration_factor(config, calibration)
     mag_quartiles = np.sqrt(
         (calibration['distance'] * gamma)**2 + calibration['time']**2)
 
@@ -201,11 +313,14 @@ def get_thresholds(config, calibration):
     return ref_lower*frac_lower, ref_upper*frac_upper
 
 
-def hysteresis_thresholding(config, sobel_data, mask, calibration):
-    lower, upper = get_thresholds(config, calibration)
+def hysteresis_thresholding(config, sobel_data, mask, calibration,
+                            buffer=None, thresholds=None):
+    if thresholds is None:
+        thresholds = get_thresholds(config, calibration)
+    lower, upper = thresholds
     print('    thresholds:', lower, upper)
     new_mask = cp_double_threshold(
-        sobel_data.transpose([3, 2, 1, 0]).copy(),
+        transposed_copy(sobel_data, buffer),
         mask.transpose([2, 1, 0]),
         1. / upper,
         1. / lower)
@@ -215,7 +330,8 @@ def hysteresis_thresholding(config, sobel_data, mask, calibration):
 def apply_mask_to_edges(edges, mask, time_margin):
     edges[:time_margin] = 0
     edges[-time_margin:] = 0
-    return edges * ~mask
+    np.logical_and(edges, ~mask, out=edges)
+    return edges
 
 
 def transfer_magnitudes(x, y):
@@ -234,7 +350,8 @@ def compute_canny_edges(config, data_set, calibration):
     box = data_set.box
 
     sigma_t, sigma_x = get_sigmas(config)
-    weights = get_sobel_weights(config, calibration)
+    gamma = get_calibration_factor(config, calibration)
+    weights = get_sobel_weights(config, calibration, gamma)
     print("    calibrated weights:",
           ['{:~P}'.format(w) for w in weights])
 
@@ -242,16 +359,16 @@ def compute_canny_edges(config, data_set, calibration):
         print("    tapering")
         taper_masked_area(data, [0, 5, 5], 50)
 
-    smooth_data = gaussian_filter(box, data, [sigma_t, sigma_x, sigma_x])
+    smooth_data = gaussian_filter(
+        box, data, [sigma_t, sigma_x, sigma_x], parallel=not config.single)
     sobel_data = sobel_filter(box, smooth_data, weight=weights)
 
     max_signal_value = 1 / sobel_data[-1].min()
 
-    gamma = get_calibration_factor(config, calibration)
     mag_quartiles = np.sqrt(
         (calibration['distance'] * gamma)**2 + calibration['time']**2)
     max_signal_value_piC=mag_quartiles[4]
-    lower, upper = get_thresholds(config, calibration)
+    lower, upper = get_thresholds(config, calibration, gamma)
     print("maximum signal in control:", max_signal_value_piC)
     print("maximum signal in data:", max_signal_value)
     print("upper threshold:", upper)
@@ -260,148 +377,144 @@ def compute_canny_edges(config, data_set, calibration):
 
     pixel_sobel = sobel_filter(box, smooth_data, physical=False)
     pixel_sobel = transfer_magnitudes(pixel_sobel, sobel_data)
-    sobel_maxima = maximum_suppression(pixel_sobel)
+    # the transposed copies for both steps share a single buffer
+    buffer = np.empty(sobel_data.shape[::-1], dtype=sobel_data.dtype)
+    sobel_maxima = maximum_suppression(pixel_sobel, buffer)
 
     if isinstance(data, np.ma.core.MaskedArray):
         sobel_maxima = apply_mask_to_edges(sobel_maxima, data.mask, 10)
 
-    edges = hysteresis_thresholding(config, sobel_data, sobel_maxima, calibration)
+    edges = hysteresis_thresholding(
+        config, sobel_data, sobel_maxima, calibration, buffer,
+        thresholds=(lower, upper))
 
-    return dict(sobel=sobel_data, edges=edges)
+    # the signal strength, 1 / sobel_data[3], is needed in several places
+    inv_mag = np.reciprocal(sobel_data[3])
+
+    return dict(sobel=sobel_data, edges=edges, inv_mag=inv_mag)
 
 
 def compute_maxTgrad(canny):
-    tgrad = canny['sobel'][0]/canny['sobel'][3]       # unit('1/year');
-    tgrad_residual = tgrad - np.mean(tgrad, axis=0)   # remove time mean
-    maxm = canny['edges'].max(axis=0)		      # mask
-    maxTgrad = np.max(abs(tgrad_residual), axis=0)    # maximum of time gradient
-    maxTgrad = maxTgrad * maxm
+    if 'inv_mag' in canny:
+        tgrad = canny['sobel'][0] * canny['inv_mag']  # unit('1/year');
+    else:
+        tgrad = canny['sobel'][0]/canny['sobel'][3]
+    tgrad -= np.mean(tgrad, axis=0)                   # remove time mean
+    maxm = canny['edges'].any(axis=0)                 # mask
+    maxTgrad = np.maximum(tgrad.max(axis=0),          # maximum of time gradient
+                          -tgrad.min(axis=0))
+    maxTgrad *= maxm
     maxTgrad[np.isnan(maxTgrad)]=0                    # can be nan when var is constant
-    indices_mask=np.where(maxTgrad>np.max(maxTgrad))  # set missing values to 0
-    maxTgrad[indices_mask]=0                          # otherwise they show on map
+    if np.ma.isMaskedArray(maxTgrad):
+        # masked values may hide huge fill values; set those to 0,
+        # otherwise they show on map
+        indices_mask=np.where(maxTgrad>np.max(maxTgrad))
+        maxTgrad[indices_mask]=0
     return maxTgrad
 
 ### There are many possible ways to quantify abruptness.
 # This one has been labeled "measure 15j" during the testing:
-def compute_measure15j(mask, years, data, cutoff_length, chunk_max_length, chunk_min_length):
-
-    idx = np.where(mask)
-    indices=np.asarray(idx)
-
-    measure15j_3d=mask*0.0
-
-    shapeidx=np.shape(idx)
-    nofresults=shapeidx[1]
-
-    for result in range(nofresults):
-        [dim0,dim1,dim2]=indices[:,result]
-
-        if mask[dim0, dim1, dim2] == 1:
-            index=dim0
-            if ( index-cutoff_length >= 0 ) and ( index + cutoff_length + 1 <= np.size(data,axis=0) ):
-
-                # determine last index of first chunk, and first index of second chunk
-                # this takes into account how many points aroung the abrupt shift under
-                # consideration are removed, and whether there are other abrupt shifts
-                #in the vicinity
-
-                # first, remove cutoff length (called ctrans in paper)
-                chunk1_data=data[0:index-cutoff_length,dim1,dim2]
-                chunk2_data=data[index+cutoff_length+1:,dim1,dim2]
-                chunk1_years=years[0:index-cutoff_length]
-                chunk2_years=years[index+cutoff_length+1:]
-                # chunk1_mask=mask[0:index-cutoff_length,dim1,dim2]
-                # chunk2_mask=mask[index+cutoff_length+1:,dim1,dim2]
-
-                if np.size(chunk1_data) > chunk_max_length:
-                    chunk1_start=np.size(chunk1_data)-chunk_max_length
-                else:
-                    chunk1_start=0
-                if np.size(chunk2_data) > chunk_max_length:
-                    chunk2_end=chunk_max_length
-                else:
-                    chunk2_end=np.size(chunk2_data)
-
-                chunk1_data_short=chunk1_data[chunk1_start:]
-                chunk2_data_short=chunk2_data[0:chunk2_end]
-                # chunk1_mask_short=chunk1_mask[chunk1_start:]
-                # chunk2_mask_short=chunk2_mask[0:chunk2_end]
-                chunk1_years_short=chunk1_years[chunk1_start:]-years[dim0]
-                chunk2_years_short=chunk2_years[0:chunk2_end]-years[dim0]
-
-
-                # # check if there are other edges in these chunks, and cut them off
-                # if np.sum(chunk1_mask_short) > 0:
-                #     #print("There are other edges in chunk 1")
-                #     index_edges = np.where(chunk1_mask_short)   # locate all other edges in chunk 1
-                #     index_edge=np.max(index_edges)        # take the last one (closest to abrupt shift under consideration here)
-                #     if index_edge + cutoff_length >= np.size(chunk1_data_short):   # also consider the cutoff length for that other edge
-                #         # chunk1_data_short=[]
-                #         # if not enough data is left let the other edge(s) here
-                #         pass
-                #     else:
-                #         # if chunck lenght will be too small after cutting off,
-                #         # don't cut data
-                #         if np.size(chunk1_data_short[index_edge+cutoff_length:]) < chunk_min_length:
-                #             pass
-                #         else:
-                #             chunk1_data_short=chunk1_data_short[index_edge+cutoff_length:]
-                #             chunk1_years_short=chunk1_years_short[index_edge+cutoff_length:]
-
-                # if np.sum(chunk2_mask_short) > 0:
-                #     #print("There are other edges in chunk 2")
-                #     index_edges = np.where(chunk2_mask_short)   # locate all other edges in chunk 1
-                #     index_edge=np.min(index_edges)        # take the last one (closest to abrupt shift under consideration here)
-                #     if index_edge - cutoff_length < 0 :   # also consider the cutoff length for that other edge
-                #         # chunk2_data_short=[]
-                #         # if not enough data is left let the other edge(s) here
-                #         pass
-                #     else:
-                #         # if chunck length will be too small after cutting off,
-                #         # don't cut data
-                #         if np.size(chunk2_data_short[0:index_edge-cutoff_length]) < chunk_min_length:
-                #             pass
-                #         else:
-                #             chunk2_data_short=chunk2_data_short[0:index_edge-cutoff_length]
-                #             chunk2_years_short=chunk2_years_short[0:index_edge-cutoff_length]
-
-
-                N1=np.size(chunk1_data_short)
-                N2=np.size(chunk2_data_short)
-
-                if not ((N1 < chunk_min_length) or (N2 < chunk_min_length)):
-
-                    slope_chunk1, intercept_chunk1, r_value, p_value, std_err = stats.linregress(chunk1_years_short, chunk1_data_short)
-                    # chunk1_regline=intercept_chunk1 + slope_chunk1*chunk1_years_short
-
-                    slope_chunk2, intercept_chunk2, r_value, p_value, std_err = stats.linregress(chunk2_years_short, chunk2_data_short)
-                    # chunk2_regline=intercept_chunk2 + slope_chunk2*chunk2_years_short
-
-                    # mean_std=(np.nanstd(chunk1_data_short, ddof=1)+np.nanstd(chunk2_data_short, ddof=1))/2
-                    chunk1_std = np.nanstd(chunk1_data_short, ddof=1)
-                    chunk2_std = np.nanstd(chunk2_data_short, ddof=1)
-                    pooled_std = np.sqrt(
-                        ((N1 - 1) * chunk1_std**2 + (N2 - 1) * chunk2_std**2) / (N1 + N2 - 2)
-                    )
-
-                    if pooled_std == 0:
-                        mean_chunk1=np.mean(chunk1_data_short)
-                        mean_chunk2=np.mean(chunk2_data_short)
-                        if mean_chunk1 == mean_chunk2:
-                            measure15j_3d[dim0,dim1,dim2]=0
-                        else:
-                            measure15j_3d[dim0,dim1,dim2]=9e99
-                    else:
-                        measure15j_3d[dim0,dim1,dim2]=abs(intercept_chunk1-intercept_chunk2)/pooled_std
-                else:
-                    measure15j_3d[dim0,dim1,dim2] = - 1
-            else:
-                measure15j_3d[dim0,dim1,dim2] = - 1
+def chunk_statistics(years, data, edges, start, length, max_length):
+    """Fit straight lines to a set of chunks of time series at once. Each
+    chunk is padded to `max_length` time steps; the padding is excluded
+    from all sums.
+
+    :param years: ndarray with the year of each time step
+    :param data: ndarray with dimensions (time, lat, lon)
+    :param edges: tuple of index arrays (time, lat, lon) of the edges; the
+        years of each chunk are taken relative to the year of its edge
+    :param start: ndarray with the first time index of each chunk
+    :param length: ndarray with the number of time steps in each chunk
+    :param max_length: maximum length of a chunk
+    :return: tuple of ndarrays (intercept, mean, variance), where the
+        variance ignores nans, like `np.nanstd` with `ddof=1` does
+    """
+    t, i, j = edges
+    inside = np.arange(max_length) < length[:, None]
+    steps = np.where(inside, start[:, None] + np.arange(max_length), 0)
+
+    # the sums are accumulated in double precision, also for float32 data
+    x = np.where(inside, years[steps] - years[t][:, None], 0.0)
+    y = np.where(
+        inside, data[steps, i[:, None], j[:, None]].astype(np.float64), 0.0)
+
+    x_mean = x.sum(axis=1) / length
+    y_mean = y.sum(axis=1) / length
+    x_dev = np.where(inside, x - x_mean[:, None], 0.0)
+    slope = (x_dev * (y - y_mean[:, None])).sum(axis=1) \
+        / (x_dev**2).sum(axis=1)
+    intercept = y_mean - slope * x_mean
+
+    valid = inside & ~np.isnan(y)
+    n_valid = valid.sum(axis=1)
+    y_valid = np.where(valid, y, 0.0)
+    y_valid_mean = y_valid.sum(axis=1) / n_valid
+    variance = (np.where(valid, y - y_valid_mean[:, None], 0.0)**2).sum(
+        axis=1) / (n_valid - 1)
+
+    return intercept, y_mean, variance
+
+
+def compute_measure15j(mask, years, data, cutoff_length, chunk_max_length,
+                       chunk_min_length, edge_idx=None, block_size=65536,
+                       parallel=False):
+    """Compute the abruptness of each edge: the difference between the
+    intercepts of linear fits to the time series before and after the
+    edge, divided by the pooled standard deviation of both chunks. The
+    `cutoff_length` time steps on either side of the edge are left out;
+    edges for which a chunk would be shorter than `chunk_min_length` are
+    given a value of -1.
+
+    All edges are processed together, in blocks of `block_size` edges, to
+    bound the size of the temporary arrays. If `parallel` is set, the
+    blocks are shared out over a pool of threads. If the indices of the edges,
+    `np.nonzero(mask)`, are already known, they can be given as `edge_idx`.
+    """
+    data = np.ma.getdata(data)
+    n_time = data.shape[0]
+    years = np.asarray(years)
+    t, i, j = np.nonzero(mask) if edge_idx is None else edge_idx
+
+    # number of time steps in the chunks before and after each edge
+    n1 = np.minimum(t - cutoff_length, chunk_max_length)
+    n2 = np.minimum(n_time - t - cutoff_length - 1, chunk_max_length)
+
+    measure = np.full(t.size, -1.0)
+    selected = np.flatnonzero(
+        np.minimum(n1, n2) >= max(chunk_min_length, 0))
+
+    def compute_block(block):
+        edges = t[block], i[block], j[block]
+        N1, N2 = n1[block], n2[block]
+        intercept1, mean1, variance1 = chunk_statistics(
+            years, data, edges, edges[0] - cutoff_length - N1, N1,
+            chunk_max_length)
+        intercept2, mean2, variance2 = chunk_statistics(
+            years, data, edges, edges[0] + cutoff_length + 1, N2,
+            chunk_max_length)
+
+        pooled_std = np.sqrt(
+            ((N1 - 1) * variance1 + (N2 - 1) * variance2) / (N1 + N2 - 2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            abruptness = abs(intercept1 - intercept2) / pooled_std
+        measure[block] = np.where(
+            pooled_std == 0, np.where(mean1 == mean2, 0, 9e99), abruptness)
+
+    n_blocks = -(-selected.size // block_size)
+    if parallel:
+        n_blocks = max(n_blocks, os.cpu_count() or 1)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(
+                compute_block, np.array_split(selected, n_blocks)))
+    else:
+        for block in np.array_split(selected, max(n_blocks, 1)):
+            compute_block(block)
+
+    measure15j_3d = np.zeros(mask.shape)
+    measure15j_3d[t, i, j] = measure
 
     measure15j=np.max(measure15j_3d,axis=0)
     measure15j[np.isnan(measure15j)]=0
-    indices_mask=np.where(measure15j>np.max(measure15j))  # set missing values to 0
-    measure15j[indices_mask]=0                            # otherwise they show on map
 
     return {
         'measure15j_3d': measure15j_3d,
@@ -416,13 +529,30 @@ def write_netcdf_2d(field, filename):
     ncfile.close()
 
 
-def write_netcdf_3d(field, filename):
+def write_netcdf_3d(field, filename, chunk_size=32):
     import netCDF4
+    if field.dtype == bool:
+        field = field.view(np.uint8)
     ncfile = netCDF4.Dataset(filename, "a", format="NETCDF4")
-    ncfile.variables['outdata'][:,:,:]=field
+    outdata = ncfile.variables['outdata']
+    # write a few time steps at a time, to keep the chunk cache small
+    for t in range(0, field.shape[0], chunk_size):
+        outdata[t:t+chunk_size,:,:] = field[t:t+chunk_size]
     ncfile.close()
 
 
+def netcdf_encoding(shape, chunk_size=32, time_chunk_size=128):
+    """Encoding for a variable written with xarray to NetCDF4: zlib
+    compression with the shuffle filter, in chunks of `chunk_size` pixels
+    in latitude and longitude. For data with a time axis, chunks span up
+    to `time_chunk_size` time steps."""
+    chunks = tuple(min(n, chunk_size) for n in shape[-2:])
+    if len(shape) == 3:
+        chunks = (min(shape[0], time_chunk_size),) + chunks
+    return {'zlib': True, 'complevel': 4, 'shuffle': True,
+            'chunksizes': chunks}
+
+
 def save_abruptness_to_netcdf4(abruptness, data_set, filename):
 
     lon = data_set.box.lon
@@ -445,7 +575,8 @@ def save_abruptness_to_netcdf4(abruptness, data_set, filename):
         },
         attrs=dict(description="maximum abruptness")
     )
-    ds.to_netcdf(filename)
+    ds.to_netcdf(filename, encoding={
+        "abruptness": netcdf_encoding(abruptness.shape)})
 
 
 def save_mask_to_netcdf4(mask, data_set, filename):
@@ -475,7 +606,7 @@ def save_mask_to_netcdf4(mask, data_set, filename):
         },
         attrs=dict(description="edges")
     )
-    ds.to_netcdf(filename)
+    ds.to_netcdf(filename, encoding={"mask": netcdf_encoding(mask.shape)})
 
 
 def save_data_to_netcdf4(data_set, variable, filename):
@@ -506,28 +637,31 @@ def save_data_to_netcdf4(data_set, variable, filename):
         },
         attrs=dict(description="data")
     )
-    ds.to_netcdf(filename)
+    ds.to_netcdf(filename, encoding={
+        "{}".format(variable): netcdf_encoding(data.shape)})
 
 
 def write_ts(ts, filename):
-   file = open(str(filename),'w')
-   np.savetxt(file, ts, fmt='%s', delimiter=" ")
-   file.close()
+    ts = np.asarray(ts)
+    fmt = '%d' if np.issubdtype(ts.dtype, np.integer) else '%.6g'
+    np.savetxt(str(filename), ts, fmt=fmt, delimiter=" ")
+    return Path(filename)
 
 
-def generate_standard_map_plot(box, field, title, filename):
+def generate_standard_map_plot(box, field, title, filename, fig=None,
+                               images=None):
     import matplotlib
     my_cmap = matplotlib.cm.get_cmap('rainbow')
     my_cmap.set_under('w')
     if np.max(abs(field)) > 0:
         fig = plot_plate_carree(
             box, field, transform=ccrs.PlateCarree(), patch_greenwich=False,
-            cmap=my_cmap, vmin=1e-30
+            cmap=my_cmap, vmin=1e-30, fig=fig
         )
     else:
         fig = plot_plate_carree(
             box, field, transform=ccrs.PlateCarree(), patch_greenwich=False,
-            cmap=my_cmap, vmin=-1e-30, vmax=1e-30
+            cmap=my_cmap, vmin=-1e-30, vmax=1e-30, fig=fig
         )
 
     # fig = plt.figure(figsize=(20, 10))
@@ -542,11 +676,10 @@ def generate_standard_map_plot(box, field, title, filename):
     # plt.close()
 
     fig.suptitle(title, fontsize=20)
-    fig.savefig(str(filename), bbox_inches='tight')
-    return Path(filename)
+    return save_figure(fig, filename, images)
 
 
-def generate_timeseries_plot(config, box, data, abruptness, abruptness_3d, title, filename):
+def generate_timeseries_plot(config, box, data, abruptness, abruptness_3d, title, filename, images=None):
     import matplotlib
     sigma_t, sigma_x = get_sigmas(config)
     if np.max(abs(abruptness)) > 0:
@@ -554,16 +687,14 @@ def generate_timeseries_plot(config, box, data, abruptness, abruptness_3d, title
         latind=np.nanargmax(np.nanmax(abruptness, axis=1))
         ts=data[:,latind,lonind]
         years = np.array([dd.year for dd in box.dates])
-        fig = plt.figure()
-        ax=plt.subplot(111)
+        fig = Figure()
+        ax = fig.add_subplot(111)
 
         ### smoothed data
-        sigma_t, sigma_x = get_sigmas(config)
         if config.taper and isinstance(data, np.ma.core.MaskedArray):
             taper_masked_area(data, [0, 5, 5], 50)
-        smooth_data = gaussian_filter(box, data, [sigma_t, sigma_x, sigma_x])
-
-        ts_smooth=smooth_data[:,latind,lonind]
+        ts_smooth = gaussian_filter_3d_point(
+            box, data, sigma_t, sigma_x, sigma_x, latind, lonind)
 
         ax.plot(years, ts, 'k', years, ts_smooth, 'b--')
 
@@ -586,54 +717,25 @@ def generate_timeseries_plot(config, box, data, abruptness, abruptness_3d, title
         fig.suptitle(title, fontsize=20)
         ax.set_xlabel('year', fontsize=20)
         ax.set_ylabel('data', fontsize=20)
-        fig.savefig(str(filename), bbox_inches='tight')
-        return Path(filename)
-
-
-def label_regions(mask, min_size=0):
-    labels, n_features = ndimage.label(
-        mask, ndimage.generate_binary_structure(3, 3))
-    big_enough = [x for x in range(1, n_features+1)
-                  if (labels == x).sum() > min_size]
-    return dict(
-        n_features=n_features,
-        regions=np.where(np.isin(labels, big_enough), labels, 0),
-        labels=big_enough
-    )
-
-
-def generate_region_plot(box, mask, title, filename, min_size=0):
-    import matplotlib
-    my_cmap = matplotlib.cm.get_cmap('rainbow')
-    my_cmap.set_under('w')
-    labels, n_features = ndimage.label(
-        mask, ndimage.generate_binary_structure(3, 3))
-    print('    n_features:', n_features)
-    if n_features > 0:
-        big_enough = [x for x in range(1, n_features+1)
-        	          if (labels == x).sum() > min_size]
-        regions = np.where(np.isin(labels, big_enough), labels, 0)
-        regions_show=regions.max(axis=0)
-        fig = plot_plate_carree(
-            box, regions_show, transform=ccrs.PlateCarree(), patch_greenwich=False,
-            cmap=my_cmap, vmin=1
-        )
-        fig.suptitle(title)
-        fig.savefig(str(filename), bbox_inches='tight')
-        return Path(filename)
+        return save_figure(fig, filename, images)
 
 
-def generate_scatter_plot(mask,sb,colourdata,sizedata,colourbarlabel,gamma,lower_threshold,upper_threshold,title,filename):
+def generate_scatter_plot(mask,sb,colourdata,sizedata,colourbarlabel,gamma,lower_threshold,upper_threshold,title,filename,edge_idx=None,images=None):
 
         ### obtain location of edges in space and time, the magnitude of the gradients and their abruptness
         ## arrays with data from the points with edges (mask==1)
-        idx    = np.where(mask)
-        sizdata  = sizedata[idx[0], idx[1], idx[2]]
-        coldata  = colourdata[idx[0], idx[1], idx[2]]
+        ## colour and size data may be given as sparse grids, e.g.
+        ## years[:, None, None]; they are broadcast, never materialized
+        idx    = np.nonzero(mask) if edge_idx is None else edge_idx
+        sizdata  = np.broadcast_to(sizedata, mask.shape)[idx]
+        coldata  = np.broadcast_to(colourdata, mask.shape)[idx]
         sobel  = sb[:, idx[0], idx[1], idx[2]]
-        sgrad = np.sqrt(sobel[1]**2 + sobel[2]**2) / gamma
-        sgrad = sgrad/sobel[3]*1000    # scale to 1000 km
-        tgrad = sobel[0]/sobel[3]*10      # scale to 10 years
+        inv_norm = np.reciprocal(sobel[3])
+        sgrad = np.hypot(sobel[1], sobel[2])
+        sgrad *= inv_norm
+        sgrad *= 1000 / gamma          # scale to 1000 km
+        tgrad = sobel[0] * inv_norm
+        tgrad *= 10                    # scale to 10 years
 
         #### sort the input in order to show most abrupt ones on top of the others in scatter plot
         inds = np.argsort(coldata)
@@ -642,8 +744,8 @@ def generate_scatter_plot(mask,sb,colourdata,sizedata,colourbarlabel,gamma,lower
         import matplotlib
         my_cmap = matplotlib.cm.get_cmap('rainbow')
         my_cmap.set_under('w')
-        fig = plt.figure()
-        ax=plt.subplot(111)
+        fig = Figure()
+        ax = fig.add_subplot(111)
         matplotlib.rc('xtick', labelsize=16)
         matplotlib.rc('ytick', labelsize=16)
 
@@ -654,16 +756,16 @@ def generate_scatter_plot(mask,sb,colourdata,sizedata,colourbarlabel,gamma,lower
 
         # ellipse showing the aspect ratio. for scaling_factor=1 would be a circle
         # the radius of that circle is the upper threshold
-        plt.plot(dx, dt, c='k')
+        ax.plot(dx, dt, c='k')
 
         ## ellipse based on the lower threshold:
         dt = lower_threshold * np.sin(dp) * 10
         dx = lower_threshold * np.cos(dp) / gamma * 1000
-        plt.plot(dx, dt, c='k')
+        ax.plot(dx, dt, c='k')
 
         #data
-        plt.scatter(sgrad[inds], tgrad[inds],s=sizdata[inds]**2,c=coldata[inds], marker = 'o', cmap =my_cmap );
-        cbar=plt.colorbar()
+        points = ax.scatter(sgrad[inds], tgrad[inds],s=sizdata[inds]**2,c=coldata[inds], marker = 'o', cmap =my_cmap );
+        cbar=fig.colorbar(points, ax=ax)
         cbar.set_label(colourbarlabel)
         matplotlib.rcParams.update({'font.size': 16})
         ax.set_xlabel('spatial gradient in units / 1000 km')
@@ -680,26 +782,22 @@ def generate_scatter_plot(mask,sb,colourdata,sizedata,colourbarlabel,gamma,lower
         ax.set_ylim(Tmin, Tmax)
 
         #fig.suptitle(title)
-        fig.savefig(str(filename), bbox_inches='tight')
-        return Path(filename)
-
-
-def compute_years_maxabrupt(box, mask, abruptness_3d, abruptness):
-    idx=np.where(mask)
-    indices=np.asarray(idx)
-    mask_max=mask*0
-    shapeidx=np.shape(idx)
-    nofresults=shapeidx[1]
-    for result in range(nofresults):
-        [dim0,dim1,dim2]=indices[:,result]
-        if (abruptness_3d[dim0, dim1, dim2] == abruptness[dim1,dim2]) and abruptness[dim1,dim2] > 0:
-            mask_max[dim0, dim1, dim2] = 1
+        return save_figure(fig, filename, images)
+
+
+def compute_years_maxabrupt(box, mask, abruptness_3d, abruptness,
+                            edge_idx=None):
+    t, i, j = np.nonzero(mask) if edge_idx is None else edge_idx
+    is_max = (abruptness_3d[t, i, j] == abruptness[i, j]) \
+        & (abruptness[i, j] > 0)
     years = np.array([dd.year for dd in box.dates])
-    years_maxabrupt=(years[:,None,None]*mask_max).sum(axis=0)
+    years_maxabrupt = np.zeros(abruptness.shape, dtype=years.dtype)
+    np.add.at(years_maxabrupt, (i[is_max], j[is_max]), years[t[is_max]])
     return years_maxabrupt
 
 
-def generate_year_plot(box, years_maxabrupt, title, filename):
+def generate_year_plot(box, years_maxabrupt, title, filename, fig=None,
+                       images=None):
     import matplotlib
     my_cmap = matplotlib.cm.get_cmap('rainbow')
     my_cmap.set_under('w')
@@ -707,47 +805,52 @@ def generate_year_plot(box, years_maxabrupt, title, filename):
     minval = np.min(years_maxabrupt[np.nonzero(years_maxabrupt)])
     fig = plot_plate_carree(
         box, years_maxabrupt, transform=ccrs.PlateCarree(), patch_greenwich=False,
-        cmap=my_cmap, vmin=minval, vmax=maxval
+        cmap=my_cmap, vmin=minval, vmax=maxval, fig=fig
     )
     fig.suptitle(title, fontsize=20)
-    fig.savefig(str(filename), bbox_inches='tight')
-    return Path(filename)
+    return save_figure(fig, filename, images)
 
 
-def generate_event_count_timeseries_plot(box, mask, title, filename):
-    fig = plt.figure()
-    ax=plt.subplot(111)
+def generate_event_count_timeseries_plot(box, mask, title, filename,
+                                         images=None):
+    fig = Figure()
+    ax = fig.add_subplot(111)
     ax.plot(box.dates, mask.sum(axis=1).sum(axis=1))
     ax.set_title(title, fontsize=20)
     ax.set_xlabel('year', fontsize=20)
     ax.set_ylabel('events', fontsize=20)
-    fig.savefig(str(filename), bbox_inches='tight')
-    return Path(filename)
+    return save_figure(fig, filename, images)
 
 
 def make_report(config, data_set, calibration, canny_edges):
     output_path  = Path(config.output_folder)
-    output_raw_path  = Path(config.output_raw_folder)
+    output_raw_path  = Path(config.output_raw_folder) / config.model
 
     # gamma = get_calibration_factor(config, calibration)
     years = np.array([dd.year for dd in data_set.box.dates])
     #years_timeseries_out = write_ts(years, output_path / "years_timeseries.txt")
 
     mask=canny_edges['edges']
+    edge_idx=np.nonzero(mask)
+    # without edges there is no abruptness to measure or plot
+    if edge_idx[0].size == 0:
+        print("No edges detected, no need to continue.")
+        return None
     event_count=mask.sum(axis=0)
 
     # lower_threshold, upper_threshold = get_thresholds(config, calibration)
-    # years3d=years[:,None,None]*mask
-    # lats=data_set.box.lat
-    # lats3d=lats[None,:,None]*mask
-    # lons=data_set.box.lon
-    # lons3d=lons[None,None,:]*mask
+    # sparse grids, broadcast against the mask by generate_scatter_plot
+    # years3d, lats3d, lons3d = np.meshgrid(
+    #     years, data_set.box.lat, data_set.box.lon,
+    #     indexing='ij', sparse=True)
 
     maxTgrad      = compute_maxTgrad(canny_edges)
 
     ## abruptness
     # Changed 2 to 4
-    measures      = compute_measure15j(mask, years, data_set.data, 3, 30, 15)
+    measures      = compute_measure15j(
+        mask, years, data_set.data, 3, 30, 15, edge_idx=edge_idx,
+        parallel=not config.single)
     abruptness_3d = measures['measure15j_3d']
     abruptness    = measures['measure15j']
 
@@ -756,34 +859,41 @@ def make_report(config, data_set, calibration, canny_edges):
     # if np.max(abruptness) < 3.0:
     #     return None
 
-    years_maxabrupt = compute_years_maxabrupt(data_set.box, mask, abruptness_3d, abruptness)
+    years_maxabrupt = compute_years_maxabrupt(
+        data_set.box, mask, abruptness_3d, abruptness, edge_idx)
+
+    # rendered images, kept to compose the overview figures; the PNG
+    # files are written all at once at the end
+    images = {}
 
     # event_count_timeseries = mask.sum(axis=1).sum(axis=1)
     signal_plot  = generate_signal_plot(
         config, calibration, data_set.box, canny_edges['sobel'], "signal",
-        output_path / "signal.png")
-    # region_plot  = generate_region_plot(
-    #     data_set.box, canny_edges['edges'], "regions",
-    #     output_path / "regions.png")
+        output_path / "signal.png", inv_mag=canny_edges.get('inv_mag'),
+        images=images)
     event_count_timeseries_plot = generate_event_count_timeseries_plot(
         data_set.box, canny_edges['edges'], "event count",
-        output_path / "event_count_timeseries.png")
+        output_path / "event_count_timeseries.png", images=images)
+    # all maps are drawn on the same figure, one after the other
+    map_fig = reuse_figure('map', figsize=(20, 10))
     event_count_plot = generate_standard_map_plot(
         data_set.box, event_count, "event count",
-        output_path / "event_count.png")
+        output_path / "event_count.png", fig=map_fig, images=images)
     abruptness_plot  = generate_standard_map_plot(
         data_set.box, abruptness,
-        "abruptness", output_path / "abruptness.png")
+        "abruptness", output_path / "abruptness.png", fig=map_fig,
+        images=images)
     maxTgrad_plot    = generate_standard_map_plot(
         data_set.box, maxTgrad,
-        "max. time gradient", output_path / "maxTgrad.png")
+        "max. time gradient", output_path / "maxTgrad.png", fig=map_fig,
+        images=images)
     timeseries_plot = generate_timeseries_plot(
         config, data_set.box, data_set.data, abruptness, abruptness_3d, "data at grid cell with largest abruptness",
-        output_path / "timeseries.png")
+        output_path / "timeseries.png", images=images)
 
     year_plot = generate_year_plot(
         data_set.box, years_maxabrupt, "year of largest abruptness",
-        output_path / "years_maxabrupt.png")
+        output_path / "years_maxabrupt.png", fig=map_fig, images=images)
     # scatter_plot_abrupt=generate_scatter_plot(
     #     mask,canny_edges['sobel'],abruptness_3d,abruptness_3d,"abruptness",gamma,lower_threshold,
     #     upper_threshold,"space versus time gradients", output_path / "scatter_abruptness.png")
@@ -799,48 +909,28 @@ def make_report(config, data_set, calibration, canny_edges):
 
     # event_count_timeseries_out = write_ts(event_count_timeseries, output_path / "event_count_timeseries.txt")
 
-    # Save all maps to a single file
-    image1 = plt.imread(os.path.join(output_path, "event_count.png"))
-    image2 = plt.imread(os.path.join(output_path, "years_maxabrupt.png"))
-    image3 = plt.imread(os.path.join(output_path, "abruptness.png"))
-    image4 = plt.imread(os.path.join(output_path, "maxTgrad.png"))
-    width = 2900
-    height = 1800
-    dpi = 100
-    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(int(width/dpi), int(height/dpi)))
-    ax1.imshow(image1)
-    ax1.axis("off")
-    ax2.imshow(image2)
-    ax2.axis("off")
-    ax3.imshow(image3)
-    ax3.axis("off")
-    ax4.imshow(image4)
-    ax4.axis("off")
-    plt.savefig(os.path.join(output_path, "map_plots.png"), bbox_inches="tight")
+    # Save all maps to a single file, tiled from the images rendered above
+    def image(name):
+        return images.get(output_path / name)
+
+    images[output_path / "map_plots.png"] = tile_images([
+        [image("event_count.png"), image("years_maxabrupt.png")],
+        [image("abruptness.png"), image("maxTgrad.png")]])
 
     # Save all time series plots to a single file
-    image1 = plt.imread(os.path.join(output_path, "timeseries.png"))
-    image2 = plt.imread(os.path.join(output_path, "signal.png"))
-    image3 = plt.imread(os.path.join(output_path, "event_count_timeseries.png"))
-    width = 625
-    height = 1475
-    fig, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(int(width/dpi), int(height/dpi)))
-    ax1.imshow(image1)
-    ax1.axis("off")
-    ax2.imshow(image2)
-    ax2.axis("off")
-    ax3.imshow(image3)
-    ax3.axis("off")
-    plt.savefig(os.path.join(output_path, "timeseries_plots.png"), bbox_inches="tight")
+    images[output_path / "timeseries_plots.png"] = tile_images([
+        [image("timeseries.png")], [image("signal.png")],
+        [image("event_count_timeseries.png")]])
+    write_images(images, parallel=not config.single)
 
     # save data
     np.savez_compressed(
-        os.path.join(output_raw_path, config.model, "output.npz"),
+        output_raw_path / "output.npz",
         abruptness_3d=abruptness_3d, edges_3d=mask
     )
-    # abruptness_out = save_abruptness_to_netcdf4(abruptness, data_set, os.path.join(output_raw_path, config.model, "abruptness.nc"))
-    # edge_mask_out = save_mask_to_netcdf4(mask, data_set, os.path.join(output_raw_path, config.model, "edge_mask_detected.nc"))
-    data_out = save_data_to_netcdf4(data_set, config.variable, os.path.join(output_raw_path, config.model, "data_out.nc"))
+    # abruptness_out = save_abruptness_to_netcdf4(abruptness, data_set, output_raw_path / "abruptness.nc")
+    # edge_mask_out = save_mask_to_netcdf4(mask, data_set, output_raw_path / "edge_mask_detected.nc")
+    data_out = save_data_to_netcdf4(data_set, config.variable, output_raw_path / "data_out.nc")
 
     return {
         'calibration': calibration,
@@ -867,12 +957,30 @@ def generate_report(config):
     output_path.mkdir(parents=True, exist_ok=True)
     data_set = open_data_files(config)
     control_set = open_pi_control(config)
-    if config.annual:
-        data_set = annual_mean(data_set)
-        control_set = annual_mean(control_set)
+
+    # reports that only differ in scenario or thresholds share the
+    # calibration on the pi-control run
+    cache = None
+    if config.calibration_cache:
+        cache = calibration_cache_path(config, control_set)
+    if cache is not None and cache.exists():
+        print("Using cached calibration:", cache)
+        calibration = read_calibration(cache)
+        data_set = reduce_data_set(config, data_set)
     else:
-        data_set = select_month(config, data_set)
-        control_set = select_month(config, control_set)
-    calibration = compute_calibration(config, control_set)
+        control_set = reduce_data_set(config, control_set)
+        if config.single:
+            calibration = compute_calibration(config, control_set)
+            data_set = reduce_data_set(config, data_set)
+        else:
+            # the data is read while the calibration is computed; NetCDF
+            # is not thread safe, so the files are never read concurrently
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(reduce_data_set, config, data_set)
+                calibration = compute_calibration(config, control_set)
+                data_set = future.result()
+        if cache is not None:
+            write_calibration(cache, calibration)
+
     canny_edges = compute_canny_edges(config, data_set, calibration)
     return make_report(config, data_set, calibration, canny_edges)